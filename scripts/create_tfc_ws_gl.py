@@ -1,9 +1,19 @@
+import io
 import os
+import re
+import tarfile
 import time
 import argparse
 import pytfc
 import gitlab
 import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import requests
+from requests.adapters import HTTPAdapter
+from pytfc.requestor import Requestor
+
+from rendering import inject_tfvars
 
 TFE_HOSTNAME = os.getenv('TFE_HOSTNAME', 'app.terraform.io')
 TFE_TOKEN = os.getenv('TFE_TOKEN')
@@ -13,82 +23,234 @@ GL_URL = os.getenv('GL_URL', 'https://gitlab.com')
 GL_TOKEN = os.getenv('GL_TOKEN')
 GL_PROJECT_ID = os.getenv('GL_PROJECT_ID')
 
+TERMINAL_PLAN_STATES = frozenset({
+    'planned',
+    'planned_and_finished',
+    'policy_checked',
+    'apply_queued',
+    'applying',
+    'applied'
+})
+TERMINAL_APPLY_STATES = frozenset({
+    'applied',
+    'planned_and_finished'
+})
+ERROR_STATES = frozenset({'errored', 'canceled', 'discarded'})
+
+LOOKUP_CACHE_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'tfc-ss', 'lookups.json')
+LOOKUP_CACHE_TTL = 3600
+
+
+class PooledRequestor(Requestor):
+    """
+    pytfc Requestor that issues every HTTP verb through a shared
+    requests.Session so TCP+TLS connections are pooled across the
+    client's API calls.
+    """
+    session = requests
+
+    def post(self, path, payload):
+        url = self._base_uri + path
+        r = self.session.post(url=url, headers=self._headers, data=json.dumps(payload))
+        r.raise_for_status()
+        return r
+
+    def get(self, path, filters=None, page_number=None, page_size=None,
+            include=None, search=None, query=None, since=None):
+        url = self._base_uri + path
+        query_params = []
+        if filters is not None:
+            if not isinstance(filters, list):
+                raise TypeError(
+                    "The `filters` query parameter must be of the type `list`.")
+            query_params += [f'filter{f}' for f in filters]
+        if page_number is not None:
+            query_params.append(f'page[number]={page_number}')
+        if page_size is not None:
+            query_params.append(f'page[size]={page_size}')
+        if include is not None:
+            query_params.append(f'include={include}')
+        if search is not None:
+            query_params += [
+                f'search[{k}]={search[k]}'
+                for k in ('name', 'tags', 'exclude-tags', 'version', 'user', 'commit')
+                if k in search
+            ]
+        if query is not None:
+            query_params.append(f'q={query}')
+        if since is not None:
+            query_params.append(f'since={since}')
+        if query_params:
+            url += '?' + '&'.join(query_params)
+        r = self.session.get(url=url, headers=self._headers)
+        r.raise_for_status()
+        return r
+
+    def patch(self, path, payload):
+        url = self._base_uri + path
+        r = self.session.patch(url=url, headers=self._headers, data=json.dumps(payload))
+        r.raise_for_status()
+        return r
+
+    def delete(self, path, payload=None):
+        url = self._base_uri + path
+        r = self.session.delete(url=url, headers=self._headers, data=json.dumps(payload))
+        r.raise_for_status()
+        return r
+
+
+def _cached_lookup(kind, org, name, fetch):
+    """
+    Utility function to cache TFC name -> ID lookups on disk
+    so repeat invocations skip the list-and-filter API calls.
+    """
+    cache = {}
+    try:
+        if time.time() - os.path.getmtime(LOOKUP_CACHE_PATH) < LOOKUP_CACHE_TTL:
+            with open(LOOKUP_CACHE_PATH, 'r') as cache_file:
+                cache = json.load(cache_file)
+    except (OSError, json.JSONDecodeError):
+        cache = {}
+
+    key = f'{kind}/{org}/{name}'
+    if key not in cache:
+        result = fetch()
+        if not result:
+            return result
+        cache[key] = result
+        os.makedirs(os.path.dirname(LOOKUP_CACHE_PATH), exist_ok=True)
+        with open(LOOKUP_CACHE_PATH, 'w') as cache_file:
+            json.dump(cache, cache_file)
+
+    return cache[key]
+
 
-def tfc_api_wf(tfc_client, ws_id, tf_dir):
+def _drop_cached_lookup(kind, org, name):
+    """
+    Utility function to evict a cached name -> ID entry after
+    the API 404s on it.
+    """
+    try:
+        with open(LOOKUP_CACHE_PATH, 'r') as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, json.JSONDecodeError):
+        return
+    if cache.pop(f'{kind}/{org}/{name}', None) is not None:
+        with open(LOOKUP_CACHE_PATH, 'w') as cache_file:
+            json.dump(cache, cache_file)
+
+
+_RUN_STATUS_RE = re.compile(rb'"status"\s*:\s*"([^"]+)"')
+
+
+def _run_status(response):
+    """
+    Utility function to pull the run status out of a runs.show
+    response without decoding the entire JSON document.
+    """
+    match = _RUN_STATUS_RE.search(response.content)
+    if match is not None:
+        return match.group(1).decode()
+    return response.json()['data']['attributes']['status']
+
+
+def _watch_run(run_id, session=None):
+    """
+    Utility function to wait on a Run over a single streaming
+    events request when the TFC/E instance supports it. Returns
+    the terminal status, or None when streaming is unavailable
+    and the caller should fall back to polling.
+    """
+    url = f'https://{TFE_HOSTNAME}/api/v2/runs/{run_id}/events'
+    headers = {
+        'Authorization': f'Bearer {TFE_TOKEN}',
+        'Accept': 'text/event-stream'
+    }
+    http = session if session is not None else requests
+    try:
+        with http.get(url, headers=headers, stream=True, timeout=3600) as stream:
+            if stream.status_code != 200:
+                return None
+            for line in stream.iter_lines():
+                match = _RUN_STATUS_RE.search(line)
+                if match is None:
+                    continue
+                status = match.group(1).decode()
+                if status in TERMINAL_APPLY_STATES or status in ERROR_STATES:
+                    return status
+                print(f"[tfc] Waiting for run to finish... {status}")
+    except requests.RequestException:
+        return None
+    return None
+
+
+def wait_for_status(tfc_client, run_id, terminal_states, error_states,
+                    initial=1.0, max_delay=15.0, timeout=3600):
+    """
+    Utility function to poll a Run's status with exponential
+    backoff until it reaches a terminal or error state.
+    """
+    delay = initial
+    start = time.monotonic()
+    while True:
+        status = _run_status(tfc_client.runs.show(run_id=run_id))
+        if status in terminal_states:
+            return status
+        elif status in error_states:
+            print(f"[tfc] Run {status}. Exiting.")
+            exit()
+        if time.monotonic() - start > timeout:
+            raise TimeoutError(
+                f"Timed out after {timeout}s waiting on Run '{run_id}' (last status: {status}).")
+        print(f"[tfc] Waiting for run to finish... {status}")
+        time.sleep(delay)
+        delay = min(delay * 1.5, max_delay)
+
+
+def tfc_api_wf(tfc_client, ws_id, tf_dir, session=None):
     """
     Function to execute TFC/E API-driven run workflow.
     """
-    cv_id = tfc_client.configuration_versions.create_and_upload(
+    cv = tfc_client.configuration_versions.create(
         ws_id=ws_id,
-        source_tf_dir=tf_dir,
-        auto_queue_runs=False,
-        cleanup=True
+        auto_queue_runs=False
     )
+    cv_id = cv.json()['data']['id']
+    upload_url = cv.json()['data']['attributes']['upload-url']
+
+    print(f"[tfc] Packaging '{tf_dir}' in memory and uploading...")
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for entry in os.scandir(tf_dir):
+            if entry.name.endswith(('.tf', '.tfvars')):
+                tar.add(entry.path, arcname=entry.name)
+    http = session if session is not None else requests
+    upload = http.put(upload_url, data=buf.getvalue(),
+        headers={'Content-Type': 'application/octet-stream'})
+    upload.raise_for_status()
 
     run = tfc_client.runs.create(
         ws_id=ws_id,
         cv_id=cv_id,
         auto_apply=True
     )
-    
+
     run_id = run.json()['data']['id']
     return run_id
 
-def py_dict_to_hcl_map(py_dict):
-    """
-    Utility function to convert a Python
-    dictionary to an HCL map.
-    """
-    max_key_length = max(len(k) for k in py_dict.keys())
-    hcl_map = ["{"]
-    
-    for k, v in py_dict.items():
-        kv_spacing = max_key_length - len(k) + 1
-        if isinstance(v, str):
-            fmt_val = f'"{v}"' if not v.startswith('"') else v
-        else:
-            fmt_val = v
-        hcl_map.append(f'  {k}{" " * kv_spacing}= {fmt_val}')
-    hcl_map.append("}")
+_GL_PROJECT_CACHE = {}
 
-    return "\n".join(hcl_map)
 
-def inject_tfvars(template_path, vars):
+def _gl_project(gl_client, gl_project_id):
     """
-    Utility function to inject the input variable values
-    into the terraform.tfvars.tpl template file.
+    Utility function to cache GitLab project handles so repeat
+    invocations against the same project skip the lookup call.
     """
-    tfvars_rendered = []
-    max_key_length = max(len(key) for key in vars.keys())
-
-    with open(template_path, 'r') as input_file:
-        for line in input_file:
-            parts = line.split('=')
-            if len(parts) == 2:
-                key = parts[0].strip()
-                value = vars.get(key, None)
-                
-                if value is not None:
-                    if isinstance(value, str):
-                        fmt_line = f'{key.ljust(max_key_length)} = "{value}"\n'
-                        tfvars_rendered.append(fmt_line)
-                    elif isinstance(value, int):
-                        fmt_line = f'{key.ljust(max_key_length)} = {value}\n'
-                        tfvars_rendered.append(fmt_line)
-                    elif isinstance(value, list):
-                        value_str = f"{value}"
-                        fmt_line = f'{key.ljust(max_key_length)} = {value_str}\n'
-                        tfvars_rendered.append(fmt_line)
-                    elif isinstance(value, dict):
-                        hcl_map = py_dict_to_hcl_map(value)
-                        fmt_line = f'{key.ljust(max_key_length)} = {hcl_map}\n'
-                        tfvars_rendered.append(fmt_line)
-                    else:
-                        print(f"Unexpected format: {type(value)}:")
-                        print(value)
-                        print("Skipping this variable.")
-    
-    return ''.join(tfvars_rendered)
+    key = (id(gl_client), gl_project_id)
+    if key not in _GL_PROJECT_CACHE:
+        _GL_PROJECT_CACHE[key] = gl_client.projects.get(gl_project_id)
+    return _GL_PROJECT_CACHE[key]
 
 def gl_commit_payload(dst_path, content):
     """
@@ -105,22 +267,23 @@ def gitlab_config(gl_client, gl_project_id, templates_dir, dst_dir, input_vars):
     """
     Function to create new folder and files in existing GitLab project.
     """
-    gl_project = gl_client.projects.get(gl_project_id)
+    gl_project = _gl_project(gl_client, gl_project_id)
     os.makedirs(dst_dir, exist_ok=True)
     changes_list = []
-    for tf_file in os.listdir(templates_dir):
-        if tf_file.endswith('.tf'):
-            src_path = os.path.join(templates_dir, tf_file)
-            dst_path = os.path.join(dst_dir, tf_file)
-            content = open(src_path, 'r').read()
-            
-            print(f"[gl] Staging commit for '{dst_path}' in repo...")
-            tf_changes = gl_commit_payload(dst_path, content)
-            changes_list.append(tf_changes)
+    tf_entries = [e for e in os.scandir(templates_dir) if e.name.endswith('.tf')]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        tf_contents = list(executor.map(
+            lambda e: (e.name, Path(e.path).read_text()), tf_entries))
 
-            print(f"[gl] Creating '{dst_path}' locally...")
-            with open(src_path, 'rb') as src_file, open(dst_path, 'wb') as dst_file:
-                dst_file.write(src_file.read())
+    for tf_file, content in tf_contents:
+        dst_path = os.path.join(dst_dir, tf_file)
+
+        print(f"[gl] Staging commit for '{dst_path}' in repo...")
+        tf_changes = gl_commit_payload(dst_path, content)
+        changes_list.append(tf_changes)
+
+        print(f"[gl] Creating '{dst_path}' locally...")
+        Path(dst_path).write_text(content)
 
     if input_vars is not None:
         src_tfvars_path = f'{templates_dir}/template.tfvars.tpl'
@@ -145,20 +308,23 @@ def gitlab_config(gl_client, gl_project_id, templates_dir, dst_dir, input_vars):
 
     print("[gl] Pushing new commit to repo...")
     script_name = os.path.basename(__file__)
-    gl_project.commits.create({
+    gl_commit = gl_project.commits.create({
         'branch': 'main',
         'actions': changes_list,
         'commit_message': f'Created by {script_name}'
     })
 
-def tfc_ws_create(tfc_client, name, project_name, vcs_repo, oauth_token_id, dst_dir, varset_name, outputs):
+    return gl_commit.id
+
+def tfc_ws_create(tfc_client, name, project_name, vcs_repo, oauth_token_id, dst_dir, varset_name):
     """
-    Function to create new TFC Workspace, trigger a Terraform
-    plan and apply, and return any outputs specified.
+    Function to create new TFC Workspace and apply a
+    Variable Set to it when one is specified.
     """
     is_vcs_workflow = True if vcs_repo is not None else False
     project_id = (
-        tfc_client.projects.get_project_id(name=project_name)
+        _cached_lookup('project', TFE_ORG, project_name,
+            lambda: tfc_client.projects.get_project_id(name=project_name))
         if project_name is not None
         else None
     )
@@ -167,7 +333,7 @@ def tfc_ws_create(tfc_client, name, project_name, vcs_repo, oauth_token_id, dst_
     oauth_token_id = oauth_token_id if is_vcs_workflow else None
 
     print(f"[tfc] Creating workspace '{name}'...")
-    ws = tfc_client.workspaces.create(
+    ws_kwargs = dict(
         name=name,
         project_id=project_id,
         identifier=vcs_repo,
@@ -176,61 +342,100 @@ def tfc_ws_create(tfc_client, name, project_name, vcs_repo, oauth_token_id, dst_
         trigger_patterns=trigger_patterns,
         queue_all_runs=False
     )
+    try:
+        ws = tfc_client.workspaces.create(**ws_kwargs)
+    except Exception as e:
+        if project_name is None or '404' not in str(e):
+            raise
+        print("[tfc] Cached project ID looks stale. Refetching...")
+        _drop_cached_lookup('project', TFE_ORG, project_name)
+        ws_kwargs['project_id'] = _cached_lookup('project', TFE_ORG, project_name,
+            lambda: tfc_client.projects.get_project_id(name=project_name))
+        ws = tfc_client.workspaces.create(**ws_kwargs)
     ws_id = ws.json()['data']['id']
 
     if varset_name is not None:
         print(f"[tfc] Fetching variable set ID for {varset_name}...")
-        varset_id = tfc_client.variable_sets.get_varset_id(name=varset_name)
+        varset_id = _cached_lookup('varset', TFE_ORG, varset_name,
+            lambda: tfc_client.variable_sets.get_varset_id(name=varset_name))
         print("[tfc] Applying variable set to workspace...")
-        tfc_client.variable_sets.apply_to_workspace(varset_id=varset_id, ws_id=ws_id)
+        try:
+            tfc_client.variable_sets.apply_to_workspace(varset_id=varset_id, ws_id=ws_id)
+        except Exception as e:
+            if '404' not in str(e):
+                raise
+            print("[tfc] Cached variable set ID looks stale. Refetching...")
+            _drop_cached_lookup('varset', TFE_ORG, varset_name)
+            varset_id = _cached_lookup('varset', TFE_ORG, varset_name,
+                lambda: tfc_client.variable_sets.get_varset_id(name=varset_name))
+            tfc_client.variable_sets.apply_to_workspace(varset_id=varset_id, ws_id=ws_id)
+
+    return ws_id
 
+def _cv_commit_sha(tfc_client, cv_id):
+    """
+    Utility function to fetch the VCS commit SHA a configuration
+    version was ingressed from, or None when the CV has no
+    ingress attributes.
+    """
+    try:
+        commit_info = tfc_client.configuration_versions.show_commit_info(cv_id=cv_id)
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return None
+        raise
+    return commit_info.json()['data']['attributes']['commit-sha']
+
+def tfc_run_and_wait(tfc_client, ws_id, vcs_repo, dst_dir, outputs, commit_sha=None, session=None):
+    """
+    Function to trigger a Terraform plan and apply on a
+    Workspace and return any outputs specified.
+    """
+    is_vcs_workflow = True if vcs_repo is not None else False
     script_name = os.path.basename(__file__)
     if is_vcs_workflow:
         cv_id = tfc_client.configuration_versions._get_latest_cv_id(ws_id=ws_id)
+        if commit_sha is not None:
+            delay = 0.25
+            start = time.monotonic()
+            while True:
+                cv_sha = _cv_commit_sha(tfc_client, cv_id)
+                if cv_sha is None or cv_sha == commit_sha:
+                    break
+                if time.monotonic() - start > 300:
+                    raise TimeoutError(
+                        f"Timed out waiting on TFC to ingest commit '{commit_sha}'.")
+                print(f"[tfc] Waiting for TFC to ingest the pushed commit... {cv_sha}")
+                time.sleep(delay)
+                delay = min(delay * 2, 10)
+                cv_id = tfc_client.configuration_versions._get_latest_cv_id(ws_id=ws_id)
+        delay = 0.25
         while True:
             cv_status = tfc_client.configuration_versions.get_cv_status(cv_id)
             if cv_status == 'uploaded':
                 break
-            else:
-                time.sleep(2)
-                print(f"[tfc] Waiting for code to upload... {cv_status}")
-        time.sleep(1)
+            print(f"[tfc] Waiting for code to upload... {cv_status}")
+            time.sleep(delay)
+            delay = min(delay * 2, 10)
         print("[tfc] Running VCS-driven workflow.")
         run = tfc_client.runs.create(ws_id=ws_id, auto_apply=True, message=f'Triggered by {script_name}')
         run_id = run.json()['data']['id']
     else:
         print("[tfc] Running API-driven workflow.")
-        run_id = tfc_api_wf(tfc_client, ws_id, tf_dir=dst_dir)
+        run_id = tfc_api_wf(tfc_client, ws_id, tf_dir=dst_dir, session=session)
     
-    while True:
-        plan_status = tfc_client.runs.show(run_id=run_id).json()['data']['attributes']['status']
-        if (plan_status == 'planned' or 
-            plan_status == 'planned_and_finished' or 
-            plan_status == 'policy_checked' or
-            plan_status == 'apply_queued' or 
-            plan_status == 'applying' or
-            plan_status == 'applied'):
-            break
-        elif plan_status == 'errored':
-            print(f"[tfc] Plan errored. Exiting.")
-            exit()
-        print(f"[tfc] Waiting for plan to finish... {plan_status}")
-        # TODO: add timeout value and logic
-        time.sleep(5)
+    status = _watch_run(run_id, session=session)
+    if status is None:
+        wait_for_status(tfc_client, run_id, TERMINAL_PLAN_STATES, ERROR_STATES)
+        wait_for_status(tfc_client, run_id, TERMINAL_APPLY_STATES, ERROR_STATES)
+    elif status in ERROR_STATES:
+        print(f"[tfc] Run {status}. Exiting.")
+        exit()
 
-    while True:
-        apply_status = tfc_client.runs.show(run_id=run_id).json()['data']['attributes']['status']
-        if apply_status == 'applied' or apply_status == 'planned_and_finished':
-            break
-        elif apply_status == 'errored':
-            print(f"[tfc] Apply errored. Exiting.")
-            exit()
-        print(f"[tfc] Waiting for apply to finish... {apply_status}")
-        # TODO: add timeout value and logic
-        time.sleep(5)
-    
     if outputs is not None:
         outputs_list = [item.strip(',') for item in outputs]
+        delay = 1.0
+        start = time.monotonic()
         while True:
             try:
                 current_state = tfc_client.state_versions.get_current(ws_id=ws_id).json()
@@ -238,18 +443,26 @@ def tfc_ws_create(tfc_client, name, project_name, vcs_repo, oauth_token_id, dst_
                     break
                 print("[tfc] Waiting for outputs to be processed...")
             except Exception as e:
-                if str(e).startswith('404 tfc_client Error: Not Found for url:'):
-                    time.sleep(2)
-                else:
+                if not str(e).startswith('404 tfc_client Error: Not Found for url:'):
                     print(f"[tfc] An unexpected exception occurred: {e}")
                     exit("[tfc] Exiting script.")
+            if time.monotonic() - start > 3600:
+                raise TimeoutError(
+                    f"Timed out waiting on outputs of Workspace '{ws_id}' to be processed.")
+            time.sleep(delay)
+            delay = min(delay * 1.5, 15.0)
 
         sv_id = current_state['data']['id']
-        sv_outputs = tfc_client.state_version_outputs.list(sv_id=sv_id).json()
-        outputs_data = {}
-        for i in sv_outputs['data']:
-            if i['attributes']['name'] in outputs_list:
-                outputs_data[i['attributes']['name']] = i['attributes']['value']
+        sv_outputs = tfc_client._requestor.get(
+            path=f'/state-versions/{sv_id}/outputs',
+            filters=[f'[name]={",".join(outputs_list)}']
+        ).json()
+        wanted = frozenset(outputs_list)
+        outputs_data = {
+            o['attributes']['name']: o['attributes']['value']
+            for o in sv_outputs['data']
+            if o['attributes']['name'] in wanted
+        }
 
         if outputs_data:
             print("[tfc] Printing outputs:")
@@ -315,28 +528,44 @@ def main():
     else:
         input_vars = None
 
-    tfc_client = pytfc.Client(hostname=TFE_HOSTNAME, token=TFE_TOKEN, org=TFE_ORG)
-    gl_client = gitlab.Gitlab(url=GL_URL, private_token=GL_TOKEN)
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+    PooledRequestor.session = session
+
+    tfc_client = pytfc.Client(hostname=TFE_HOSTNAME, token=TFE_TOKEN, org=TFE_ORG,
+        requestor=PooledRequestor)
+    gl_client = gitlab.Gitlab(url=GL_URL, private_token=GL_TOKEN, session=session)
     
     # TODO: Validate args.name (Workspace name) is available
 
-    gitlab_config(
-        gl_client=gl_client,
-        gl_project_id=GL_PROJECT_ID,
-        templates_dir=templates_dir,
-        dst_dir=dst_dir,
-        input_vars=input_vars
-    )
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        gl_future = executor.submit(gitlab_config,
+            gl_client=gl_client,
+            gl_project_id=GL_PROJECT_ID,
+            templates_dir=templates_dir,
+            dst_dir=dst_dir,
+            input_vars=input_vars
+        )
+        ws_future = executor.submit(tfc_ws_create,
+            tfc_client=tfc_client,
+            name=args.name,
+            project_name=args.project_name,
+            vcs_repo=args.vcs_repo,
+            oauth_token_id=args.oauth_token_id,
+            dst_dir=dst_dir,
+            varset_name=args.varset_name
+        )
+        commit_sha = gl_future.result()
+        ws_id = ws_future.result()
 
-    tfc_ws_create(
+    tfc_run_and_wait(
         tfc_client=tfc_client,
-        name=args.name,
-        project_name=args.project_name,
+        ws_id=ws_id,
         vcs_repo=args.vcs_repo,
-        oauth_token_id=args.oauth_token_id,
         dst_dir=dst_dir,
-        varset_name=args.varset_name,
-        outputs=args.outputs
+        outputs=args.outputs,
+        commit_sha=commit_sha,
+        session=session
     )
 
 if __name__ == "__main__":
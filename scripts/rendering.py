@@ -0,0 +1,58 @@
+"""
+Shared helpers for rendering Terraform-flavored values and
+tfvars files from the templates directory.
+"""
+import re
+import json
+from pathlib import Path
+
+
+def py_dict_to_hcl_map(py_dict):
+    """
+    Utility function to convert a Python
+    dictionary to an HCL map.
+    """
+    w = max(map(len, py_dict))
+    body = '\n'.join(
+        f'  {k:<{w}} = {json.dumps(v) if isinstance(v, str) else v}'
+        for k, v in py_dict.items()
+    )
+    return '{\n' + body + '\n}'
+
+_TFVAR_LINE = re.compile(r'^[ \t]*(?P<key>[A-Za-z_]\w*)\s*=.*$', re.M)
+
+_TFVAR_FORMATTERS = {
+    str: lambda v: f'"{v}"',
+    int: lambda v: f'{v}',
+    bool: lambda v: 'true' if v else 'false',
+    list: lambda v: f'{v}',
+    dict: py_dict_to_hcl_map,
+}
+
+def inject_tfvars(template_path, vars):
+    """
+    Utility function to inject the input variable values
+    into the terraform.tfvars.tpl template file.
+    """
+    tfvars_rendered = []
+    max_key_length = max(len(key) for key in vars.keys())
+    template = Path(template_path).read_text()
+    remaining = set(vars)
+
+    for match in _TFVAR_LINE.finditer(template):
+        key = match.group('key')
+        value = vars.get(key, None)
+        if value is None:
+            continue
+        fmt = _TFVAR_FORMATTERS.get(type(value))
+        if fmt is None:
+            print(f"Unexpected format: {type(value)}:")
+            print(value)
+            print("Skipping this variable.")
+            continue
+        tfvars_rendered.append(f'{key:<{max_key_length}} = {fmt(value)}\n')
+        remaining.discard(key)
+        if not remaining:
+            break
+
+    return ''.join(tfvars_rendered)